@@ -1,6 +1,16 @@
 from tempfile import NamedTemporaryFile as tempfile  # for tests only
 from array import array
-from enum import Enum
+from bisect import bisect_right
+from collections import ChainMap, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from enum import Enum, IntEnum
+from itertools import count
+import json
+import os
+import queue
+import sys
+import threading
+import time
 
 
 class Word(Enum):
@@ -18,22 +28,66 @@ class State(Enum):
     Compile = 1
 
 
-class Object(Enum):
+class Object(IntEnum):
     Literal = 0
     Word = 1
     Return = 2
+    Branch = 3  # value is the offset to jump by
+    ZeroBranch = 4  # same, but only jumps if the popped flag is zero
+    TailWord = 5  # a call with nothing left to do after it
+
+
+class Body:
+    # compound word code as parallel arrays of opcodes and operands,
+    # rather than a list of (Object, value) tuples
+    __slots__ = ("ops", "args")
+
+    def __init__(self):
+        self.ops = array('B')
+        self.args = array('q')
+
+    def append(self, object_type, object):
+        self.ops.append(object_type)
+        self.args.append(object)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __getitem__(self, offset):
+        return Object(self.ops[offset]), self.args[offset]
+
+    def __iter__(self):
+        return zip(map(Object, self.ops), self.args)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Body)
+            and self.ops == other.ops
+            and self.args == other.args
+        )
+
+    def key(self):
+        # hashable stand-in, for finding duplicate definitions
+        return self.ops.tobytes(), self.args.tobytes()
 
 
 class Definition:
+    __slots__ = ("name", "lin", "lout", "body", "control")
+
     def __init__(self, name):
         self.name = name
         self.lin = 0
         self.lout = 0
-        self.body = []
+        self.body = Body()
+        # unresolved branches: (kind, body position, stack effect there)
+        self.control = []
 
     def call(self, index, callee):
         new_lin, new_lout, _, _ = callee
-        self.body.append((Object.Word, index))
+        self.body.append(Object.Word, index)
+        self.effect(new_lin, new_lout)
+
+    def effect(self, new_lin, new_lout):
         old_lout = self.lout
         diff = new_lin - old_lout
         self.lout = new_lout
@@ -43,13 +97,93 @@ class Definition:
             self.lout -= diff
 
     def lit(self, value):
-        self.body.append((Object.Literal, value))
+        self.body.append(Object.Literal, value)
         self.lout += 1
 
     def ret(self):
-        self.body.append((Object.Return, 0))
+        self.body.append(Object.Return, 0)
+
+    def branch(self, object_type, target=None):
+        # jumps to target, or leaves the offset to be patched later
+        position = len(self.body)
+        offset = 0 if target is None else target - position
+        self.body.append(object_type, offset)
+        return position
+
+    def patch(self, position):
+        self.body.args[position] = len(self.body) - position
+
+    def pop_control(self, *kinds):
+        if len(self.control) == 0 or self.control[-1][0] not in kinds:
+            raise ValueError("Unmatched control flow in " + self.name)
+        return self.control.pop()
+
+    def if_(self):
+        self.effect(1, 0)
+        position = self.branch(Object.ZeroBranch)
+        self.control.append(("if", position, (self.lin, self.lout)))
+
+    def else_(self):
+        _, position, start = self.pop_control("if")
+        jump = self.branch(Object.Branch)
+        self.patch(position)
+        self.control.append(("else", jump, (self.lin, self.lout)))
+        self.lin, self.lout = start
+
+    def then(self):
+        kind, position, other = self.pop_control("if", "else")
+        self.patch(position)
+        # both arms must leave the stack at the same relative depth
+        lin, lout = other
+        if lout - lin != self.lout - self.lin:
+            raise ValueError("Unbalanced branches in " + self.name)
+        net = lout - lin
+        self.lin = max(self.lin, lin)
+        self.lout = self.lin + net
+
+    def begin(self, kind="begin"):
+        self.control.append((kind, len(self.body), (self.lin, self.lout)))
+
+    def until(self, kind="begin"):
+        self.effect(1, 0)
+        self.loop_back(Object.ZeroBranch, kind)
+
+    def again(self):
+        self.loop_back(Object.Branch, "begin")
+
+    def loop_back(self, object_type, kind):
+        _, position, (lin, lout) = self.pop_control(kind)
+        # a loop body must leave the stack as it found it
+        if lout - lin != self.lout - self.lin:
+            raise ValueError("Unbalanced loop in " + self.name)
+        self.branch(object_type, position)
+
+    def calls(self, indices):
+        return any(
+            object_type in (Object.Word, Object.TailWord)
+            and object in indices
+            for (object_type, object) in self.body
+        )
 
-    def end(self):
+    def mark_tail_calls(self, frame_words):
+        # a call followed by a return, possibly after some jumps, doesn't
+        # need to come back here, unless the callee uses its return address
+        ops = self.body.ops
+        args = self.body.args
+        for position in range(len(ops)):
+            if ops[position] != Object.Word or args[position] in frame_words:
+                continue
+            nxt = position + 1
+            seen = set()
+            # jumps can loop back on themselves, e.g. BEGIN AGAIN
+            while ops[nxt] == Object.Branch and nxt not in seen:
+                seen.add(nxt)
+                nxt += args[nxt]
+            if ops[nxt] == Object.Return:
+                ops[position] = Object.TailWord
+
+    def end(self, frame_words=()):
+        self.mark_tail_calls(frame_words)
         return (
             self.name,
             (
@@ -61,21 +195,376 @@ class Definition:
         )
 
 
+class Symbol:
+    # everything needed to run or compile a name, looked up in one go
+    __slots__ = ("name", "index", "speed", "lin", "lout", "offset")
+
+    def __init__(self, name, index, speed, lin, lout, offset):
+        self.name = name
+        self.index = index
+        self.speed = speed
+        self.lin = lin
+        self.lout = lout
+        self.offset = offset
+
+
+class Program:
+    # a script with its words already looked up, made by Forth.prepare;
+    # items is None if the script can only be run by Forth.do
+    __slots__ = ("text", "items", "names", "generation")
+
+    def __init__(self, text, items, names, generation):
+        self.text = text
+        self.items = items
+        self.names = names
+        self.generation = generation
+
+
+SYMBOL_CACHE_SIZE = 4096
+NOT_CACHED = object()  # symbols.get default; cached misses are None
+PROGRAM_CACHE_SIZE = 64
+# every change to any session's names gets a new generation, so
+# programs can tell whether they're still valid for a session
+GENERATIONS = count()
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+LITERAL_CACHE_SIZE = 4096
+
+
+class NumberFormat:
+    # parsing and printing for one base, kept per base by the session
+    def __init__(self, base):
+        self.base = base
+        self.fast = 2 <= base <= 36
+        digits = DIGITS[:base] if self.fast else ""
+        self.digits = digits
+        self.valid = frozenset(digits + digits.lower())
+        self.literals = {}
+
+    def parse(self, token):
+        # returns None for anything that isn't a number in this base
+        number = self.literals.get(token)
+        if number is not None:
+            return number
+        digits = token[1:] if token[:1] == "-" else token
+        if self.fast and len(digits) > 0 and self.valid.issuperset(digits):
+            number = int(token, base=self.base)
+        elif (
+            not self.fast or "+" in token or "_" in token
+            or digits[:2].lower() in ("0x", "0o", "0b")
+        ):
+            # int() also takes signs, underscores and prefixes, so keep
+            # those working
+            try:
+                number = int(token, base=self.base)
+            except ValueError:
+                return None
+        else:
+            # most words get here, and raising for each of them is slow
+            return None
+        if len(self.literals) >= LITERAL_CACHE_SIZE:
+            # start again, rather than keep only the first literals seen
+            self.literals.clear()
+        self.literals[token] = number
+        return number
+
+    def format(self, val):
+        if val < 0:
+            return "-" + self.format(-val)
+        match self.base:
+            case 10:
+                return str(val)
+            case 16:
+                return format(val, "X")
+            case 8:
+                return format(val, "o")
+            case 2:
+                return format(val, "b")
+        if val == 0:
+            return "0"
+        digits = self.digits
+        base = self.base
+        chars = []
+        while val > 0:
+            val, cur = divmod(val, base)
+            chars.append(digits[cur])
+        return "".join(reversed(chars))
+
+
+PAGE_SIZE = 1024
+
+
+class Memory:
+    # cells kept in fixed-size pages, so that forked sessions can share
+    # pages, and only copy the ones they write to
+    def __init__(self, typecode):
+        self.typecode = typecode
+        self.pages = []
+        self.owned = []  # whether each page can be written without copying
+        self.length = 0
+
+    def fork(self):
+        other = Memory(self.typecode)
+        other.pages = self.pages.copy()
+        other.length = self.length
+        other.owned = [False] * len(self.pages)
+        self.owned = [False] * len(self.pages)
+        return other
+
+    def __len__(self):
+        return self.length
+
+    def locate(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("memory index out of range")
+        return divmod(index, PAGE_SIZE)
+
+    def writable(self, page):
+        if not self.owned[page]:
+            self.pages[page] = array(self.typecode, self.pages[page])
+            self.owned[page] = True
+        return self.pages[page]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return array(self.typecode, [
+                self[i]
+                for i in range(*index.indices(self.length))
+            ])
+        page, offset = self.locate(index)
+        return self.pages[page][offset]
+
+    def __setitem__(self, index, value):
+        page, offset = self.locate(index)
+        self.writable(page)[offset] = value
+
+    def append(self, value):
+        if self.length % PAGE_SIZE == 0:
+            self.pages.append(array(self.typecode))
+            self.owned.append(True)
+        self.writable(len(self.pages) - 1).append(value)
+        self.length += 1
+
+    def grow(self, count):
+        # adds count zeroes to the end
+        zero = array(self.typecode, [0])
+        while count > 0:
+            if self.length % PAGE_SIZE == 0:
+                self.pages.append(array(self.typecode))
+                self.owned.append(True)
+            page = self.writable(len(self.pages) - 1)
+            extra = min(count, PAGE_SIZE - len(page))
+            page.extend(zero * extra)
+            self.length += extra
+            count -= extra
+
+
+OVERLAY_DEPTH = 8
+
+
+def overlay(mapping):
+    # a writable layer over mapping, which is left as it is, so forks
+    # don't have to copy lookup tables they only add to
+    if not isinstance(mapping, ChainMap):
+        return ChainMap({}, mapping)
+    if len(mapping.maps) >= OVERLAY_DEPTH:
+        # forks of forks would otherwise make lookups ever slower
+        return ChainMap(dict(mapping))
+    return mapping.new_child()
+
+
+class Output:
+    # buffers printed text, and passes it on to the sink when flushed:
+    # sink can be a file-like object, a callable, or None for stdout
+    def __init__(self, sink=None, threshold=4096):
+        self.sink = sink
+        self.threshold = threshold
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        text = "".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        sink = sys.stdout if self.sink is None else self.sink
+        if callable(sink):
+            sink(text)
+        else:
+            sink.write(text)
+
+
+class StatsExporter(threading.Thread):
+    # writes a session's stats to a file every interval seconds, for
+    # a collector to pick up; the file is replaced in one go
+    def __init__(self, session, path, interval=10, format="json"):
+        super().__init__(daemon=True)
+        self.session = session
+        self.path = path
+        self.interval = interval
+        self.format = format
+        self.stopped = threading.Event()
+
+    def export(self):
+        temp = self.path + ".tmp"
+        with open(temp, "w") as file:
+            self.session.write_stats(file, self.format)
+        os.replace(temp, self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.export()
+
+
+class Result:
+    # what a SessionPool request left behind
+    __slots__ = ("stack", "output", "error")
+
+    def __init__(self, stack, output, error):
+        self.stack = stack
+        self.output = output
+        self.error = error
+
+
+def run_session(session, script, steps=None, seconds=None):
+    written = []
+    session.out = Output(written.append)
+    session.limit(steps, seconds)
+    error = None
+    try:
+        session.do(script)
+    except Exception as e:
+        error = str(e)
+    finally:
+        session.limit()
+        session.out.flush()
+    return Result(session.S(), "".join(written), error)
+
+
+def free_threaded():
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+def base_session(setup, cell, wrap):
+    # setup is run silently, but the copies that are run aren't silent
+    session = Forth(True, cell, wrap=wrap)
+    session.do(setup)
+    session.silent = False
+    return session
+
+
+# base session for the current worker process, see SessionPool
+worker_session = None
+
+
+def start_worker(setup, cell, wrap):
+    global worker_session
+    worker_session = base_session(setup, cell, wrap)
+
+
+def run_in_worker(script, steps, seconds):
+    return run_session(worker_session.fork(), script, steps, seconds)
+
+
+class SessionPool:
+    # runs scripts on copies of a base session set up by the setup script,
+    # with limits on steps and seconds for each one; uses threads when
+    # Python has no GIL, and processes otherwise, unless told which
+    def __init__(
+        self,
+        setup="",
+        workers=4,
+        steps=None,
+        seconds=None,
+        cell=4,
+        wrap=False,
+        threads=None
+    ):
+        self.steps = steps
+        self.seconds = seconds
+        self.threads = free_threaded() if threads is None else threads
+        if self.threads:
+            self.base = base_session(setup, cell, wrap)
+            # pre-warmed sessions, put back after each request
+            self.idle = queue.SimpleQueue()
+            for _ in range(workers):
+                self.idle.put(self.base.fork())
+            self.executor = ThreadPoolExecutor(workers)
+        else:
+            self.executor = ProcessPoolExecutor(
+                workers,
+                initializer=start_worker,
+                initargs=(setup, cell, wrap)
+            )
+
+    def serve(self, script):
+        session = self.idle.get()
+        try:
+            return run_session(session, script, self.steps, self.seconds)
+        finally:
+            session.restore(self.base)
+            self.idle.put(session)
+
+    def submit(self, script):
+        if self.threads:
+            return self.executor.submit(self.serve, script)
+        return self.executor.submit(
+            run_in_worker, script, self.steps, self.seconds
+        )
+
+    def run(self, script):
+        return self.submit(script).result()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 class Forth:
-    def __init__(self, silent=False, cell=4):
+    def __init__(self, silent=False, cell=4, out=None, wrap=False):
         cell_types = {1: 'b', 2: 'h', 4: 'l', 8: 'q'}
         try:
             cell_type = cell_types[cell]
         except KeyError:
             raise RuntimeError("Invalid cell size: " + str(cell))
         self.cell = cell
+        # with wrap, arithmetic wraps around within the cell like
+        # fixed-width integers do, and true flags are -1
+        self.wrap = wrap
+        self.sign = 1 << (8 * cell - 1)
+        self.mask = (1 << (8 * cell)) - 1
+        n = Forth.to_cell if wrap else (lambda f, value: value)
+        flag = (lambda cond: -int(cond)) if wrap else int
         self.data = array(cell_type, [])
-        self.memory = array(cell_type, [])
-        self.ret = array(cell_type, [])
+        self.memory = Memory(cell_type)
+        # return stack holds code addresses, so isn't limited by cell size
+        self.ret = array('q', [])
         self.input_buffer = ""
         self.pad = ""
         self.silent = True
         self.here = 0
+        self.formats = {}
+        self.format = self.number_format(10)
+        self.out = out if isinstance(out, Output) else Output(out)
 
         def bw(instack, outstack, fun, im=False):
             return (
@@ -85,44 +574,65 @@ class Forth:
                 Speed.Immediate if im else Speed.Normal,
                 fun
             )
+
+        def cf(step):
+            # immediate control flow words, acting on the definition
+            return bw(0, 0, lambda f, x: f.control(step), im=True)
         base_words = {
-            "bd": bw(0, 0, lambda x: self.begin_definition()),
-            "postpone": bw(0, 0, lambda x: self.postpone(), im=True),
-            "word": bw(0, 0, lambda x: self.read_word()),
-            "include": bw(0, 0, lambda x: self.include()),
-            ";": bw(0, 0, lambda x: self.end_compile(), im=True),
-            ";im": bw(0, 0, lambda x: self.end_compile(im=True), im=True),
-            ";r": bw(0, 0, lambda x: self.end_compile(reduce1=True), im=True),
-            ";imr": bw(0, 0, lambda x: self.end_compile(True, True), im=True),
-            "[": bw(0, 0, lambda x: self.execute_mode(), im=True),
-            "]": bw(0, 0, lambda x: self.compile_mode()),
-            "cell": bw(0, 1, lambda x: [self.cell]),
-            "here": bw(0, 1, lambda x: [self.here]),
-            "trace": bw(0, 2, lambda x: self.trace()),
-            ",": bw(1, 0, lambda x: self.place(x[0])),
-            "literal": bw(1, 0, lambda x: self.compile_literal(x[0]), im=True),
-            "drop": bw(1, 0, lambda x: []),
-            ".": bw(1, 0, lambda x: self.fp(x)),
-            "@": bw(1, 1, lambda x: self.fetch(x[0])),
-            "r>": bw(0, 1, lambda x: self.rFetch()),
-            "dup": bw(1, 2, lambda x: x + x),
-            "!": bw(2, 0, lambda x: self.store(x[0], x[1])),
-            ">r": bw(1, 0, lambda x: self.rStore(x[0])),
-            "+": bw(2, 1, lambda x: [x[0] + x[1]]),
-            "-": bw(2, 1, lambda x: [x[0] - x[1]]),
-            "*": bw(2, 1, lambda x: [x[0] * x[1]]),
-            "/": bw(2, 1, lambda x: [x[0] // x[1]]),
-            "=": bw(2, 1, lambda x: [int(x[0] == x[1])]),
-            "<": bw(2, 1, lambda x: [int(x[0] < x[1])]),
-            "<=": bw(2, 1, lambda x: [int(x[0] <= x[1])]),
-            ">": bw(2, 1, lambda x: [int(x[0] > x[1])]),
-            ">=": bw(2, 1, lambda x: [int(x[0] >= x[1])]),
-            "<>": bw(2, 1, lambda x: [int(x[0] != x[1])]),
-            "swap": bw(2, 2, lambda x: list(reversed(x))),
-            "over": bw(2, 3, lambda x: [x[0], x[1], x[0]]),
-            "tuck": bw(2, 3, lambda x: [x[1], x[0], x[1]]),
-            "rot": bw(3, 3, lambda x: [x[1], x[2], x[0]]),
-            "-rot": bw(3, 3, lambda x: [x[2], x[0], x[1]]),
+            "bd": bw(0, 0, lambda f, x: f.begin_definition()),
+            "postpone": bw(0, 0, lambda f, x: f.postpone(), im=True),
+            "word": bw(0, 0, lambda f, x: f.read_word()),
+            "include": bw(0, 0, lambda f, x: f.include()),
+            ";": bw(0, 0, lambda f, x: f.end_compile(), im=True),
+            ";im": bw(0, 0, lambda f, x: f.end_compile(im=True), im=True),
+            ";r": bw(0, 0, lambda f, x: f.end_compile(False, True), im=True),
+            ";imr": bw(0, 0, lambda f, x: f.end_compile(True, True), im=True),
+            "[": bw(0, 0, lambda f, x: f.execute_mode(), im=True),
+            "]": bw(0, 0, lambda f, x: f.compile_mode()),
+            "cell": bw(0, 1, lambda f, x: [f.cell]),
+            "here": bw(0, 1, lambda f, x: [f.here]),
+            "trace": bw(0, 2, lambda f, x: f.trace()),
+            ",": bw(1, 0, lambda f, x: f.place(x[0])),
+            "literal": bw(
+                1, 0, lambda f, x: f.compile_literal(x[0]), im=True
+            ),
+            "drop": bw(1, 0, lambda f, x: []),
+            ".": bw(1, 0, lambda f, x: f.fp(x)),
+            "@": bw(1, 1, lambda f, x: f.fetch(x[0])),
+            "r>": bw(0, 1, lambda f, x: f.rFetch()),
+            "i": bw(0, 1, lambda f, x: f.loop_index()),
+            "dup": bw(1, 2, lambda f, x: x + x),
+            "!": bw(2, 0, lambda f, x: f.store(x[0], x[1])),
+            ">r": bw(1, 0, lambda f, x: f.rStore(x[0])),
+            "(do)": bw(2, 0, lambda f, x: f.loop_start(x[0], x[1])),
+            "(loop)": bw(0, 1, lambda f, x: f.loop_step()),
+            "if": cf(Definition.if_),
+            "else": cf(Definition.else_),
+            "then": cf(Definition.then),
+            "begin": cf(Definition.begin),
+            "until": cf(Definition.until),
+            "again": cf(Definition.again),
+            "do": bw(0, 0, lambda f, x: f.compile_do(), im=True),
+            "loop": bw(0, 0, lambda f, x: f.compile_loop(), im=True),
+            "+": bw(2, 1, lambda f, x: [n(f, x[0] + x[1])]),
+            "-": bw(2, 1, lambda f, x: [n(f, x[0] - x[1])]),
+            "*": bw(2, 1, lambda f, x: [n(f, x[0] * x[1])]),
+            "/": bw(2, 1, lambda f, x: [n(f, x[0] // x[1])]),
+            "=": bw(2, 1, lambda f, x: [flag(x[0] == x[1])]),
+            "<": bw(2, 1, lambda f, x: [flag(x[0] < x[1])]),
+            "<=": bw(2, 1, lambda f, x: [flag(x[0] <= x[1])]),
+            ">": bw(2, 1, lambda f, x: [flag(x[0] > x[1])]),
+            ">=": bw(2, 1, lambda f, x: [flag(x[0] >= x[1])]),
+            "<>": bw(2, 1, lambda f, x: [flag(x[0] != x[1])]),
+            "and": bw(2, 1, lambda f, x: [x[0] & x[1]]),
+            "or": bw(2, 1, lambda f, x: [x[0] | x[1]]),
+            "xor": bw(2, 1, lambda f, x: [x[0] ^ x[1]]),
+            "invert": bw(1, 1, lambda f, x: [~x[0]]),
+            "swap": bw(2, 2, lambda f, x: list(reversed(x))),
+            "over": bw(2, 3, lambda f, x: [x[0], x[1], x[0]]),
+            "tuck": bw(2, 3, lambda f, x: [x[1], x[0], x[1]]),
+            "rot": bw(3, 3, lambda f, x: [x[1], x[2], x[0]]),
+            "-rot": bw(3, 3, lambda f, x: [x[2], x[0], x[1]]),
         }
         self.dictionary = [
             (lin, lout, word_type, body)
@@ -139,26 +649,46 @@ class Forth:
             for (k, (_, _, _, speed, _))
             in base_words.items()
         }
-        self.lengths = array(cell_type, [
-            1 if x[2] == Word.Base
-            else len(x[3])
-            for x in self.dictionary
-        ])
+        self.lengths = array('q', [1] * len(self.dictionary))
+        # start address of each entry, for finding them from the return stack
+        self.starts = array('q', range(len(self.dictionary)))
+        # compound entries by content, for reusing duplicate definitions
+        self.entries = {}
+        self.loop_words = (self.names["(DO)"], self.names["(LOOP)"])
+        # words that use their caller's return address, so calls to them
+        # can't be made into tail calls; compound words calling any of
+        # these are added as they're defined
+        self.frame_words = {self.names["R>"], self.names[">R"]}
+        self.frame_words.add(self.names["I"])
+        self.frame_words.update(self.loop_words)
+        # words that read input, or leave execution mode, so scripts
+        # calling them can't be prepared in advance
+        self.parsing_words = {
+            self.names[name]
+            for name in ["WORD", "INCLUDE", "TRACE", "POSTPONE", "BD", "]"]
+        }
+        self.symbols = {}
+        self.programs = OrderedDict()
+        # counters for stats()
+        self.definitions = 0
+        self.duplicates = 0
+        self.aliases = 0
+        self.ret_peak = 0
+        self.limit()
+        self.generation = next(GENERATIONS)
+        # whether the dictionary is shared with a fork, see own_dictionary
+        self.shared = False
         self.state = State.Execute
         self.val = None
 
         # base must be added without using .do(), since without it
         # input-output base isn't defined
-        self.dictionary += [(
-            0,
-            1,
-            Word.Compound,
-            [(Object.Literal, self.here)]
-        )]
-        self.place(10)
-        self.names["BASE"] = len(self.dictionary) - 1
+        body = Body()
+        body.append(Object.Literal, self.here)
+        body.append(Object.Return, 0)
+        self.names["BASE"] = self.add_entry((0, 1, Word.Compound, body))
         self.speeds["BASE"] = Speed.Normal
-        self.lengths.append(1)
+        self.place(10)
 
         # : must be compiled more implicitly, then it can be used
         # to define the other initial compound words
@@ -181,22 +711,28 @@ class Forth:
     def fp(self, x):
         if self.silent:
             return []
-        val = x[0]
-        base = self.memory[0]
-        chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"[:base]
-        if val == 0:
-            print(val, end=' ')
-            return []
-        if val < 0:
-            print("-", end='')
-            val = val * -1
-        val_str = ""
-        while val > 0:
-            cur, val = val % base, val // base
-            val_str = chars[cur] + val_str
-        print(val_str, end=' ')
+        self.out.write(self.current_format().format(x[0]) + " ")
         return []
 
+    def to_cell(self, value):
+        # two's complement wraparound to the cell width
+        return ((value + self.sign) & self.mask) - self.sign
+
+    def number_format(self, base):
+        try:
+            return self.formats[base]
+        except KeyError:
+            self.formats[base] = NumberFormat(base)
+            return self.formats[base]
+
+    def current_format(self):
+        # base can be changed with ! at any time, so check the cached one;
+        # this runs for every number, so read its page directly
+        base = self.memory.pages[0][0]
+        if self.format.base != base:
+            self.format = self.number_format(base)
+        return self.format
+
     def read_word(self):
         self.input_buffer = self.input_buffer.lstrip()
         if len(self.input_buffer) == 0:
@@ -220,7 +756,7 @@ class Forth:
         return []
 
     def begin_definition(self):
-        self.val = Definition(self.pad)
+        self.val = Definition(self.pad.upper())
         return []
 
     def compile_mode(self):
@@ -243,8 +779,7 @@ class Forth:
 
     def store(self, value, index):
         if index >= len(self.memory):
-            extra = index - len(self.memory) + 1
-            self.memory += array(self.memory.typecode, extra*[0])
+            self.memory.grow(index - len(self.memory) + 1)
         self.memory[index] = value
         return []
 
@@ -254,6 +789,29 @@ class Forth:
         self.ret.append(caller_ret)
         return []
 
+    def loop_start(self, limit, index):
+        # loop limit and index go under the caller's return address
+        caller_ret = self.ret.pop()
+        self.ret.append(limit)
+        self.ret.append(index)
+        self.ret.append(caller_ret)
+        return []
+
+    def loop_step(self):
+        # ( -- finished ), dropping the loop's values when finished
+        caller_ret = self.ret.pop()
+        index = self.ret.pop() + 1
+        finished = index >= self.ret[-1]
+        if finished:
+            self.ret.pop()
+        else:
+            self.ret.append(index)
+        self.ret.append(caller_ret)
+        return [int(finished)]
+
+    def loop_index(self):
+        return [self.ret[-2]]
+
     def reset_state(self, data):
         if data:
             # intended for runtime errors (~= list.clear())
@@ -265,56 +823,78 @@ class Forth:
 
     def fail(self, str):
         self.reset_state(data=True)
+        self.out.flush()
         raise RuntimeError(str)
 
     def trace(self):
         self.read_word()
-        token = self.pad.upper()
-        if token not in self.names.keys():
-            raise RuntimeError("Undefined word: " + token)
-        lin, lout, _, _ = self.dictionary[self.names[token]]
-        return [lin, lout]
+        symbol = self.lookup(self.pad)
+        if symbol is None:
+            raise RuntimeError("Undefined word: " + self.pad.upper())
+        return [symbol.lin, symbol.lout]
 
     def orphans(self):
-        old = []
-        new = list(set(self.names.values()))
+        found = set(self.names.values())
+        new = list(found)
         while len(new) > 0:
-            old.append(new[0])
-            new = new[1:]
-            for index in new:
-                _, _, word_type, word = self.dictionary[index]
-                match word_type:
-                    case Word.Compound:
-                        children = [
-                            index
-                            for (type, index) in word
-                            if type == Object.Word
-                            and index not in old
-                            and index not in new
-                        ]
-                        new += children
+            _, _, word_type, word = self.dictionary[new.pop()]
+            match word_type:
+                case Word.Compound:
+                    children = [
+                        index
+                        for (type, index) in word
+                        if type in (Object.Word, Object.TailWord)
+                        and index not in found
+                    ]
+                    found.update(children)
+                    new += children
         return [
             index
             for index in range(len(self.dictionary))
-            if index not in old
+            if index not in found
         ]
 
     def postpone(self):
         self.read_word()
         name = self.pad
-        if name in self.names.keys():
-            self.compile_call(name)
+        symbol = self.lookup(name)
+        if symbol is not None:
+            self.compile_call(symbol)
         else:
             number = self.number_or_fail(name)
             self.compile_literal(number)
         return []
 
+    def control(self, step):
+        if self.val is None:
+            self.fail("Control flow outside of a definition")
+        try:
+            step(self.val)
+        except ValueError as error:
+            self.fail(str(error))
+        return []
+
+    def compile_do(self):
+        index, _ = self.loop_words
+        self.control(lambda val: val.call(index, self.dictionary[index]))
+        self.control(lambda val: val.begin("do"))
+        return []
+
+    def compile_loop(self):
+        _, index = self.loop_words
+        self.control(lambda val: val.call(index, self.dictionary[index]))
+        self.control(lambda val: val.until("do"))
+        return []
+
     def compile_literal(self, value):
-        self.val.lit(value)
+        try:
+            self.val.lit(value)
+        except OverflowError:
+            self.fail("Literal out of range: " + str(value))
         return []
 
-    def compile_call(self, token):
-        index = self.names[token]
+    def compile_call(self, symbol):
+        index = symbol.index
         callee = self.dictionary[index]
         self.val.call(index, callee)
         return []
@@ -323,78 +903,106 @@ class Forth:
         self.val.ret()
 
     def resolve_word_compile(self, token):
-        if token in self.names.keys():
-            speed = self.speeds[token]
-            match speed:
+        symbol = self.lookup(token)
+        if symbol is not None:
+            match symbol.speed:
                 case Speed.Normal:
-                    self.compile_call(token)
+                    self.compile_call(symbol)
                 case Speed.Immediate:
-                    self.execute_valid_token(token)
+                    self.execute_valid_token(symbol)
         else:
             number = self.number_or_fail(token)
             self.compile_literal(number)
 
     def end_definition(self, im=False):
         self.compile_ret()
-        name, entry = self.val.end()
+        name, entry = self.val.end(self.frame_words)
+        self.definitions += 1
+        lin, lout, _, body = entry
         try:
-            index = self.dictionary.index(entry)
+            index = self.entries[(lin, lout, body.key())]
             self.names[name] = index
-        except Exception:
-            self.names[name] = len(self.dictionary)
-            self.dictionary.append(entry)
-            self.lengths.append(len(self.val.body))
+            self.duplicates += 1
+        except KeyError:
+            self.names[name] = self.add_entry(entry)
+            if self.val.calls(self.frame_words):
+                self.frame_words.add(self.names[name])
+            if self.val.calls(self.parsing_words):
+                self.parsing_words.add(self.names[name])
         finally:
             self.speeds[name] = Speed.Immediate if im else Speed.Normal
 
+    def add_entry(self, entry):
+        lin, lout, word_type, body = entry
+        length = 1 if word_type == Word.Base else len(body)
+        self.starts.append(self.starts[-1] + self.lengths[-1])
+        self.lengths.append(length)
+        self.dictionary.append(entry)
+        index = len(self.dictionary) - 1
+        if word_type == Word.Compound:
+            self.entries[(lin, lout, body.key())] = index
+        return index
+
     def end_compile(self, im=False, reduce1=False):
         name = self.val.name
+        if len(self.val.control) > 0:
+            self.fail("Unresolved control flow in " + name)
+        self.own_dictionary()
+        # raw spellings may now point somewhere else
+        self.symbols.clear()
+        self.forget_programs(name)
         if not self.silent and name in self.names.keys():
-            print(name + " is redefined")
+            self.out.write(name + " is redefined\n")
         body = self.val.body
         if (reduce1 and len(body) == 1):
             object_type, object = body[0]
             match object_type:
-                case Object.Literal:
-                    self.end_definition(im=im)
                 case Object.Word:
                     self.names[name] = object
                     self.speeds[name] = Speed.Immediate if im else Speed.Normal
+                    self.aliases += 1
+                case _:
+                    self.end_definition(im=im)
         else:
             self.end_definition(im=im)
         self.reset_state(data=False)
         return []
 
+    def forget_programs(self, name):
+        # drops prepared programs using name, and marks the rest as
+        # still valid for the new generation
+        self.generation = next(GENERATIONS)
+        for text, program in list(self.programs.items()):
+            if name in program.names:
+                del self.programs[text]
+            else:
+                program.generation = self.generation
+
     def number_or_fail(self, token):
-        base = self.memory[0]
-        if len(token) > 0 and token[0] == "#":
-            base = 10
+        if token[:1] == "#":
             token = token[1:]
-        try:
-            number = int(token, base=base)
-            return number
-        except Exception:
+            number = self.number_format(10).parse(token)
+        else:
+            number = self.current_format().parse(token)
+        if number is None:
             self.fail("Undefined word: " + token)
+        if self.wrap:
+            return self.to_cell(number)
+        return number
 
     def resolve_return_stack(self, token):
         while len(self.ret) > 0:
+            if self.limited:
+                self.check_limits(token)
+            if len(self.ret) > self.ret_peak:
+                self.ret_peak = len(self.ret)
             current = self.ret.pop()
-            if current < 0 or current >= sum(self.lengths):
+            if current < 0 or current >= self.starts[-1] + self.lengths[-1]:
                 self.fail("Invalid return stack item: " + token)
 
-            dictionary_index = 0
-            offset = 0
-            s = 0
-            # while current is start of next entry or later
-            while dictionary_index < len(self.lengths):
-                s2 = s + self.lengths[dictionary_index]
-                if s2 > current:
-                    break
-                s += self.lengths[dictionary_index]
-                dictionary_index += 1
-            if dictionary_index == len(self.lengths):
-                self.fail("Return stack lookup failure: " + token)
-            assert s == sum(self.lengths[:dictionary_index])
+            # last entry starting at or before current
+            dictionary_index = bisect_right(self.starts, current) - 1
+            s = self.starts[dictionary_index]
             offset = current - s
             assert 0 <= offset < self.lengths[dictionary_index]
 
@@ -403,45 +1011,93 @@ class Forth:
                 case Word.Base:
                     # execute the word, leave nothing back on the return stack
                     assert offset == 0
-                    if lin == 0:
-                        used = []
-                        rest = self.data
-                    else:
-                        used = self.data[-lin:]
-                        rest = self.data[:-lin]
-                    new = word(used)
-                    self.data = rest + array(rest.typecode, new)
+                    data = self.data
+                    used = data[len(data) - lin:] if lin > 0 else []
+                    new = word(self, used)
+                    data[len(data) - lin:] = array(data.typecode, new)
                 case Word.Compound:
-                    # add all initial literals
-                    while offset < len(word):
-                        object_type, object = word[offset]
-                        if object_type != Object.Literal:
+                    ops = word.ops
+                    args = word.args
+                    # add all initial literals, and follow branches
+                    while True:
+                        object_type = ops[offset]
+                        if object_type == Object.Literal:
+                            self.data.append(args[offset])
+                            offset += 1
+                        elif object_type == Object.Branch:
+                            offset += args[offset]
+                            if self.limited:
+                                self.check_limits(token)
+                        elif object_type == Object.ZeroBranch:
+                            if self.data.pop() == 0:
+                                offset += args[offset]
+                                if self.limited:
+                                    self.check_limits(token)
+                            else:
+                                offset += 1
+                        else:
                             break
-                        self.data.append(object)
-                        offset += 1
-                    if offset == len(word):
-                        continue
-                    object_type, object = word[offset]
-                    if object_type == Object.Return:
+                    if ops[offset] == Object.Return:
                         continue
-                    assert object_type == Object.Word
-                    nxt = sum(self.lengths[:object])
-                    # not Return -> not last element, so can push next one
-                    self.ret.append(s + offset + 1)
-                    self.ret.append(nxt)
-
-    def execute_valid_token(self, token):
-        index = self.names[token]
+                    if ops[offset] == Object.Word:
+                        # not Return -> not last element, so can push next one
+                        self.ret.append(s + offset + 1)
+                    else:
+                        # tail call: the callee returns straight to our caller
+                        assert ops[offset] == Object.TailWord
+                    self.ret.append(self.starts[args[offset]])
+
+    def limit(self, steps=None, seconds=None):
+        # limits further execution to a number of calls and jumps, and a
+        # time in seconds from now; no arguments removes the limits
+        self.steps_left = steps
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+        self.limited = steps is not None or seconds is not None
+
+    def check_limits(self, token):
+        if self.steps_left is not None:
+            self.steps_left -= 1
+            if self.steps_left < 0:
+                self.fail("Step limit reached: " + token)
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.fail("Time limit reached: " + token)
+
+    def lookup(self, token):
+        # token is the raw spelling: cache hits skip upper() and names;
+        # misses, mostly numbers, are cached too, since end_compile
+        # clears the whole cache whenever names change
+        symbol = self.symbols.get(token, NOT_CACHED)
+        if symbol is not NOT_CACHED:
+            return symbol
+        if len(self.symbols) >= SYMBOL_CACHE_SIZE:
+            self.symbols.clear()
+        name = token.upper()
+        if name not in self.names.keys():
+            self.symbols[token] = None
+            return None
+        index = self.names[name]
+        lin, lout, _, _ = self.dictionary[index]
+        symbol = Symbol(
+            name,
+            index,
+            self.speeds[name],
+            lin,
+            lout,
+            self.starts[index]
+        )
+        self.symbols[token] = symbol
+        return symbol
+
+    def execute_valid_token(self, symbol):
         lin = len(self.data)
-        min_lin, add_lout, _, _ = self.dictionary[index]
+        min_lin = symbol.lin
         if lin < min_lin:
-            self.fail("Data stack underflow: " + token)
-        word_offset = sum(self.lengths[:index])
-        self.ret.append(word_offset)
-        self.resolve_return_stack(token)
+            self.fail("Data stack underflow: " + symbol.name)
+        self.ret.append(symbol.offset)
+        self.resolve_return_stack(symbol.name)
         lout = len(self.data)
-        if lout != lin + add_lout - min_lin:
-            self.fail("Word output size error: " + token)
+        if lout != lin + symbol.lout - min_lin:
+            self.fail("Word output size error: " + symbol.name)
 
     def skip(self, char, fail=None):
         try:
@@ -460,40 +1116,188 @@ class Forth:
             self.input_buffer = ""
         else:
             self.input_buffer = res[1]
-        return res[0].upper()
+        return res[0]
 
     def do(self, str):
-        self.input_buffer = str
-        self.input_buffer = self.input_buffer.strip()
-        while len(self.input_buffer) > 0:
-            self.read_word()
-            token = self.pad
-            if token == "(":
-                self.skip(")", "(")
-                continue
-            if token == "\\":
-                self.skip("\n")
-                continue
-            match self.state:
-                case State.Execute:
-                    if token in self.names.keys():
-                        self.execute_valid_token(token)
-                    else:
-                        number = self.number_or_fail(token)
-                        self.data.append(number)
-                case State.Compile:
-                    self.resolve_word_compile(token)
+        try:
+            self.input_buffer = str
+            self.input_buffer = self.input_buffer.strip()
+            # comments and included files can leave trailing whitespace
+            while len(self.input_buffer.lstrip()) > 0:
+                self.read_word()
+                token = self.pad
+                if token == "(":
+                    self.skip(")", "(")
+                    continue
+                if token == "\\":
+                    self.skip("\n")
+                    continue
+                match self.state:
+                    case State.Execute:
+                        symbol = self.lookup(token)
+                        if symbol is not None:
+                            self.execute_valid_token(symbol)
+                        else:
+                            number = self.number_or_fail(token)
+                            self.data.append(number)
+                    case State.Compile:
+                        self.resolve_word_compile(token)
+            self.finish()
+        finally:
+            # whatever was written before an error still gets out
+            self.out.flush()
+
+    def finish(self):
         if self.state != State.Execute:
             self.fail("Incomplete program")
         if len(self.ret) > 0:
             self.fail("Return stack must be emptied")
         if not self.silent:
-            print("ok")
+            self.out.write("ok\n")
         return
 
+    def prepare(self, script):
+        try:
+            program = self.programs[script]
+            self.programs.move_to_end(script)
+            return program
+        except KeyError:
+            pass
+        program = self.compile_program(script)
+        self.programs[script] = program
+        if len(self.programs) > PROGRAM_CACHE_SIZE:
+            self.programs.popitem(last=False)
+        return program
+
+    def compile_program(self, script):
+        # numbers are kept as tokens, since the base can change while
+        # the program runs
+        items = []
+        names = set()
+        text = script
+        while len(text.lstrip()) > 0:
+            res = text.split(maxsplit=1)
+            token = res[0]
+            text = res[1] if len(res) > 1 else ""
+            if token == "(":
+                end = text.find(")")
+                if end < 0:
+                    return Program(script, None, names, self.generation)
+                text = text[end + 1:]
+                continue
+            if token == "\\":
+                end = text.find("\n")
+                text = "" if end < 0 else text[end + 1:]
+                continue
+            names.add(token.upper())
+            symbol = self.lookup(token)
+            if symbol is None:
+                items.append((Object.Literal, token))
+            elif symbol.index in self.parsing_words:
+                return Program(script, None, names, self.generation)
+            else:
+                items.append((Object.Word, symbol))
+        return Program(script, items, frozenset(names), self.generation)
+
+    def run(self, program):
+        if program.generation != self.generation:
+            program = self.prepare(program.text)
+        if program.items is None:
+            return self.do(program.text)
+        self.input_buffer = ""
+        try:
+            for object_type, object in program.items:
+                if object_type == Object.Word:
+                    self.execute_valid_token(object)
+                else:
+                    self.data.append(self.number_or_fail(object))
+            self.finish()
+        finally:
+            self.out.flush()
+
     def S(self):
         return list(self.data).copy()
 
+    def stats(self, orphans=False):
+        # cheap counts for the session; orphans are optional, since
+        # finding them means walking the whole dictionary
+        res = {
+            "names": len(self.names),
+            "entries": len(self.dictionary),
+            "threaded_length": self.starts[-1] + self.lengths[-1],
+            "definitions": self.definitions,
+            "duplicates": self.duplicates,
+            "duplicate_rate": self.duplicates / max(self.definitions, 1),
+            "aliases": self.aliases,
+            "memory": len(self.memory),
+            "here": self.here,
+            "data_depth": len(self.data),
+            "ret_peak": self.ret_peak,
+        }
+        if orphans:
+            res["orphans"] = len(self.orphans())
+        return res
+
+    def write_stats(self, file, format="json", orphans=False):
+        stats = self.stats(orphans)
+        match format:
+            case "json":
+                file.write(json.dumps(stats) + "\n")
+            case "text":
+                file.writelines(
+                    "fpython_" + k + " " + str(v) + "\n"
+                    for k, v in stats.items()
+                )
+            case _:
+                raise RuntimeError("Unknown stats format: " + format)
+
+    def fork(self):
+        # a new session with the same state; the dictionary and memory
+        # are shared until one of the two sessions changes them
+        if self.state != State.Execute or self.val is not None:
+            raise RuntimeError("Cannot fork in the middle of a definition")
+        child = object.__new__(Forth)
+        child.__dict__.update(self.__dict__)
+        child.data = array(self.data.typecode, self.data)
+        child.ret = array(self.ret.typecode, self.ret)
+        child.memory = self.memory.fork()
+        child.symbols = {}
+        child.programs = OrderedDict()
+        child.formats = {}
+        child.format = child.number_format(10)
+        child.out = Output(self.out.sink, self.out.threshold)
+        self.shared = True
+        child.shared = True
+        return child
+
+    def snapshot(self):
+        # a snapshot is just a fork that's never run
+        return self.fork()
+
+    def restore(self, snapshot):
+        # output settings are kept, everything else comes from the
+        # snapshot, which can be restored again later
+        state = snapshot.fork()
+        state.out = self.out
+        state.silent = self.silent
+        self.__dict__.update(state.__dict__)
+
+    def own_dictionary(self):
+        # copy-on-write for the dictionary and its indexes; speeds and
+        # entries are only looked up by key, so they get an overlay
+        # instead, while names is also counted and walked, so it's copied
+        if not self.shared:
+            return
+        self.dictionary = self.dictionary.copy()
+        self.names = self.names.copy()
+        self.speeds = overlay(self.speeds)
+        self.lengths = array(self.lengths.typecode, self.lengths)
+        self.starts = array(self.starts.typecode, self.starts)
+        self.entries = overlay(self.entries)
+        self.frame_words = self.frame_words.copy()
+        self.parsing_words = self.parsing_words.copy()
+        self.shared = False
+
 
 f = Forth(True)
 f.do("1 2 drop")
@@ -533,6 +1337,16 @@ f.do(": add + ;r")
 assert f.names["ADD"] == f.names["+"]
 del f
 
+# ...and otherwise defines it as usual
+f = Forth(True)
+try:
+    f.do(": t begin again ;r : u if then ;r : v 5 ;r")
+    assert f.dictionary[f.names["T"]][3][0] == (Object.Branch, 0)
+    f.do("0 u 1 u v")
+    assert f.S() == [5]
+finally:
+    del f
+
 # is case-insensitive
 f = Forth(True)
 try:
@@ -866,6 +1680,19 @@ finally:
     del file
     del f
 
+# can include files ending in whitespace or a comment
+file = tempfile(delete=False)
+file.write(b': tst 1 + ;\n\\ comment\n')
+file.close()
+f = Forth(True)
+try:
+    f.do("include " + file.name)
+    f.do("3 tst")
+    assert f.S() == [4]
+finally:
+    del file
+    del f
+
 # can take #n, for decimal number n, as a literal if #n isn't a defined word
 f = Forth(True)
 try:
@@ -929,3 +1756,478 @@ try:
     raise AssertionError("Forth(cell = 7) doesn't fail")
 except Exception:
     pass
+
+# can branch with if, else, and then
+f = Forth(True)
+try:
+    f.do(": abs dup 0 < if -1 * then ; -5 abs 3 abs")
+    assert f.S() == [5, 3]
+    f.do(": sign 0 < if -1 else 1 then ; -5 sign 5 sign trace sign")
+    assert f.S()[2:] == [-1, 1, 1, 1]
+    f.do(": pick2 if if 1 else 2 then else drop 3 then ;")
+    f.do("0 1 pick2 1 1 pick2 5 0 pick2")
+    assert f.S()[6:] == [2, 1, 3]
+finally:
+    del f
+
+# can loop with begin and until, or do and loop
+f = Forth(True)
+try:
+    f.do(": down begin 1 - dup 0 = until ; 5 down")
+    assert f.S() == [0]
+    f.do("drop : sum 0 swap 0 do i + loop ; 5 sum 1 sum")
+    assert f.S() == [10, 0]
+    f.do("drop drop : grid 0 3 0 do 4 0 do 1 + loop loop ; grid")
+    assert f.S() == [12]
+finally:
+    del f
+
+# branch arms and loop bodies must have the same stack effect
+f = Forth(True)
+for bad in [
+    ": tst if 1 then ;",
+    ": tst if 1 else then ;",
+    ": tst begin 1 0 until ;",
+    ": tst if ;",
+    ": tst then ;",
+    ": tst 1 0 do 1 loop ;",
+    "if",
+]:
+    try:
+        f.do(bad)
+    except RuntimeError:
+        assert f.state == State.Execute
+        assert f.val is None
+    else:
+        raise AssertionError(bad + " doesn't fail")
+del bad
+del f
+
+# calls in tail position don't push a return address
+f = Forth(True)
+try:
+    f.do(": a 1 ; : b 2 a ; : c if a else 3 then ; : d a 4 ;")
+    assert f.dictionary[f.names["B"]][3].ops[1] == Object.TailWord
+    assert f.dictionary[f.names["C"]][3].ops[1] == Object.TailWord
+    assert f.dictionary[f.names["D"]][3].ops[0] == Object.Word
+    f.do("b 1 c 0 c d")
+    assert f.S() == [2, 1, 1, 3, 1, 4]
+finally:
+    del f
+
+# ...except to words that use the caller's return address
+f = Forth(True)
+try:
+    f.do(": rdrop r> drop ; : tst 1 rdrop ; : tst2 tst 2 ;")
+    assert f.dictionary[f.names["TST"]][3].ops[1] == Object.Word
+    f.do("tst2")
+    assert f.S() == [1, 2]
+finally:
+    del f
+
+# ...or that call such words themselves
+f = Forth(True)
+try:
+    f.do(": yield r> r> swap >r >r ; : callee 2 yield 4 ; : caller 1 callee ;")
+    assert f.dictionary[f.names["CALLER"]][3].ops[1] == Object.Word
+    f.do("caller")
+    assert f.S() == [1, 2, 4]
+finally:
+    del f
+
+# calls followed by an endless loop aren't in tail position
+f = Forth(True)
+try:
+    f.do(": a 1 ; : t a begin again ;")
+    assert f.dictionary[f.names["T"]][3].ops[0] == Object.Word
+finally:
+    del f
+
+# words only called as tail calls aren't orphans
+f = Forth(True)
+try:
+    f.do(": a 1 ; : b a ; : a 2 ;")
+    assert f.orphans() == []
+finally:
+    del f
+
+# forks share state, but changes to either don't affect the other
+f = Forth(True)
+try:
+    f.do(": tst 1 ; here 5 ,")
+    g = f.fork()
+    assert g.dictionary is f.dictionary
+    assert g.memory.pages[0] is f.memory.pages[0]
+    g.do(": tst 2 ; : new 3 ; 9 over ! tst new 6 , here")
+    f.do("8 over ! tst")
+    assert f.S() == [1, 1]
+    assert g.S() == [1, 2, 3, 3]
+    assert "NEW" not in f.names
+    assert f.memory[1] == 8 and g.memory[1] == 9
+    assert f.here == 2 and g.here == 3
+    assert g.memory.pages[0] is not f.memory.pages[0]
+finally:
+    del f
+    del g
+
+# forks of forks layer their lookup tables, up to a limit
+f = Forth(True)
+try:
+    f.do(": im 7 ;im : dup1 1 dup ;")
+    g = f
+    for n in range(OVERLAY_DEPTH * 2):
+        g = g.fork()
+        g.do(": w" + str(n) + " " + str(n) + " ; : im 7 ;")
+        assert len(g.entries.maps) <= OVERLAY_DEPTH
+    g.do(": dup2 1 dup ;")
+    assert g.names["DUP2"] == g.names["DUP1"]
+    assert g.speeds["IM"] == Speed.Normal
+    assert f.speeds["IM"] == Speed.Immediate
+    assert type(f.speeds) is dict
+finally:
+    del f
+    del g
+
+# can restore a snapshot, more than once
+f = Forth(True)
+try:
+    f.do(": tst 1 ; here 0 ,")
+    snapshot = f.snapshot()
+    for _ in range(2):
+        f.do("3 over ! : tst 2 ; tst create x")
+        assert f.S() == [1, 2]
+        f.restore(snapshot)
+        assert "X" not in f.names
+        f.do("tst over @")
+        assert f.S() == [1, 1, 0]
+        f.restore(snapshot)
+finally:
+    del f
+    del snapshot
+
+# memory spanning several pages can be grown, read, and written
+f = Forth(True)
+try:
+    far = PAGE_SIZE * 3 + 5
+    f.do("4 " + str(far) + " ! " + str(far) + " @ " + str(far - 1) + " @")
+    assert f.S() == [4, 0]
+    g = f.fork()
+    g.do("6 " + str(far) + " !")
+    assert f.memory[far] == 4 and g.memory[-1] == 6
+    assert len(f.memory) == len(g.memory) == far + 1
+finally:
+    del f
+    del g
+    del far
+
+# can prepare scripts once and run them many times
+f = Forth(True)
+try:
+    program = f.prepare("1 2 + ( comment ) dup \\ comment\n 1 +")
+    assert f.prepare("1 2 + ( comment ) dup \\ comment\n 1 +") is program
+    assert len(program.items) == 6
+    f.run(program)
+    f.run(program)
+    assert f.S() == [3, 4, 3, 4]
+finally:
+    del f
+    del program
+
+# prepared scripts follow redefinitions of the names they use
+f = Forth(True)
+try:
+    f.do(": tst 1 ;")
+    program = f.prepare("tst a")
+    f.do("hex")
+    f.run(program)
+    f.do(": other 2 ;")
+    assert f.prepare("tst a") is program
+    f.do(": tst 3 ; : a 4 ;")
+    assert f.prepare("tst a") is not program
+    f.run(program)
+    assert f.S() == [1, 10, 3, 4]
+finally:
+    del f
+    del program
+
+# scripts that read input or compile are run as normal
+f = Forth(True)
+try:
+    program = f.prepare(": sq dup * ; 3 sq hex 10 decimal")
+    assert program.items is None
+    f.run(program)
+    assert f.S() == [9, 16]
+    program = f.prepare("create x x")
+    assert program.items is None
+    program = f.prepare("1 ( comment")
+    assert program.items is None
+finally:
+    del f
+    del program
+
+# prepared scripts fail as normal on unknown words
+f = Forth(True)
+try:
+    f.run(f.prepare("1 nope"))
+except RuntimeError:
+    assert f.S() == []
+else:
+    raise AssertionError("running an undefined word doesn't fail")
+del f
+
+# keeps counts of definitions, duplicates, and aliases
+f = Forth(True)
+try:
+    before = f.stats()
+    f.do(": a 1 + ; : b 1 + ; : c + ;r here 0 ,")
+    after = f.stats(orphans=True)
+    assert after["definitions"] - before["definitions"] == 2
+    assert after["duplicates"] - before["duplicates"] == 1
+    assert after["aliases"] - before["aliases"] == 1
+    assert after["names"] - before["names"] == 3
+    assert after["entries"] - before["entries"] == 1
+    assert after["memory"] == after["here"] == before["here"] + 1
+    assert after["data_depth"] == 1
+    assert after["orphans"] == len(f.orphans())
+finally:
+    del f
+    del before
+    del after
+
+# tracks the return stack's high-water mark, which tail calls keep low
+f = Forth(True)
+g = Forth(True)
+try:
+    f.do(": t0 1 ;")
+    g.do(": t0 1 ;")
+    for n in range(1, 50):
+        f.do(": t" + str(n) + " 0 drop t" + str(n - 1) + " ;")
+        g.do(": t" + str(n) + " t" + str(n - 1) + " 0 drop ;")
+    f.do("t49")
+    g.do("t49")
+    assert f.S() == g.S() == [1]
+    assert f.stats()["ret_peak"] <= 2
+    assert g.stats()["ret_peak"] >= 50
+finally:
+    del f
+    del g
+
+# can write stats as JSON or text, and export them periodically
+f = Forth(True)
+file = tempfile(delete=False)
+file.close()
+try:
+    with open(file.name, "w") as out:
+        f.write_stats(out)
+    with open(file.name) as out:
+        assert json.load(out)["entries"] == len(f.dictionary)
+    exporter = StatsExporter(f, file.name, interval=0.01, format="text")
+    exporter.start()
+    f.do(": tst 1 ;")
+    exporter.stop()
+    with open(file.name) as txt:
+        lines = txt.read().splitlines()
+    assert "fpython_definitions " + str(f.definitions) in lines
+finally:
+    del f
+    del file
+    del exporter
+    del lines
+    del out
+
+# can limit the number of steps or the time taken
+f = Forth(True)
+try:
+    f.do(": spin begin 0 until ; : count 0 swap 0 do 1 + loop ;")
+    f.limit(steps=1000)
+    f.do("10 count")
+    assert f.S() == [10]
+    for script in ["spin", "1000 count"]:
+        try:
+            f.do(script)
+        except RuntimeError as e:
+            assert str(e).startswith("Step limit reached")
+        else:
+            raise AssertionError(script + " doesn't hit the step limit")
+        f.limit(steps=1000)
+    f.limit(seconds=0.01)
+    try:
+        f.do("spin")
+    except RuntimeError as e:
+        assert str(e).startswith("Time limit reached")
+    else:
+        raise AssertionError("spin doesn't hit the time limit")
+    f.limit()
+    f.do("1000 count")
+    assert f.S() == [1000]
+finally:
+    del f
+    del script
+
+# session pools run scripts on copies of a base session, with limits
+with SessionPool(": sq dup * ;", workers=2, steps=1000, threads=True) as pool:
+    results = [pool.submit(str(n) + " sq .") for n in range(10)]
+    assert [r.result().stack for r in results] == [[]] * 10
+    assert [r.result().output for r in results] == [
+        str(n * n) + " ok\n" for n in range(10)
+    ]
+    result = pool.run(": sq 0 ; : spin begin again ; 3 sq spin")
+    assert result.error.startswith("Step limit reached")
+    assert pool.run("3 sq").stack == [9]
+    assert pool.run("nope").error == "Undefined word: nope"
+del pool
+del results
+del result
+
+# has bitwise words
+f = Forth(True)
+try:
+    f.do("12 10 and 12 10 or 12 10 xor 0 invert")
+    assert f.S() == [8, 14, 6, -1]
+finally:
+    del f
+
+# wrap mode wraps arithmetic to the cell size, and uses -1 for true
+f = Forth(True, cell=1, wrap=True)
+try:
+    f.do("127 1 + 100 100 * -128 1 - 1 1 = 1 2 =")
+    assert f.S() == [-128, 16, 127, -1, 0]
+    f.do("hex FF 80 decimal 300")
+    assert f.S()[-3:] == [-1, -128, 44]
+    f.do("1 2 < invert 5 invert")
+    assert f.S()[-2:] == [0, -6]
+finally:
+    del f
+f = Forth(True, cell=8, wrap=True)
+try:
+    f.do("-9223372036854775808 -1 /")
+    assert f.S() == [-9223372036854775808]
+finally:
+    del f
+
+# output goes to the given sink, buffered until do() finishes
+written = []
+f = Forth(out=written.append)
+try:
+    f.do("1 . 2 .")
+    assert written == ["1 2 ok\n"]
+    f.do("hex 1F .")
+    assert written[1:] == ["1F ok\n"]
+finally:
+    del f
+    del written
+written = []
+f = Forth(out=Output(written.append, threshold=4))
+try:
+    f.do("1 . 2 . 3 .")
+    assert "".join(written) == "1 2 3 ok\n"
+    assert len(written) > 1
+finally:
+    del f
+    del written
+written = []
+f = Forth(out=written.append)
+try:
+    try:
+        f.do("1 . 1 0 /")
+        assert False
+    except ZeroDivisionError:
+        assert written == ["1 "]
+    f.do("2 .")
+    assert written[1:] == ["2 ok\n"]
+finally:
+    del f
+    del written
+
+# compound bodies are stored as opcode and operand arrays
+f = Forth(True)
+try:
+    f.do(": tst 5 dup + ;")
+    body = f.dictionary[f.names["TST"]][3]
+    assert list(body.ops) == [
+        Object.Literal, Object.Word, Object.TailWord, Object.Return
+    ]
+    assert list(body.args)[:2] == [5, f.names["DUP"]]
+    assert len(body) == f.lengths[f.names["TST"]]
+    del body
+finally:
+    del f
+
+# return stack addresses aren't limited by the cell size
+f = Forth(True, cell=1)
+try:
+    for n in range(100):
+        f.do(": tst" + str(n) + " " + str(n) + " 1 + ;")
+    f.do("tst99")
+    assert f.S() == [100]
+finally:
+    del f
+
+# raw spellings are cached, and follow redefinitions
+f = Forth(True)
+try:
+    f.do(": tst 1 ; tst Tst")
+    assert f.lookup("tst") is f.lookup("tst")
+    f.do(": tst 2 ; tst TST")
+    assert f.lookup("tst").index == f.names["TST"]
+    assert f.S() == [1, 1, 2, 2]
+finally:
+    del f
+
+# ...as are misses, until a definition might change them
+f = Forth(True)
+try:
+    f.do("7 7")
+    assert f.symbols["7"] is None
+    try:
+        f.do("new")
+        assert False
+    except RuntimeError:
+        pass
+    f.do(": new 3 ; new")
+    assert f.S() == [3]
+finally:
+    del f
+
+# number formats parse and print in their base, including negatives
+fmt = NumberFormat(16)
+try:
+    assert fmt.parse("ff") == 255
+    assert fmt.parse("-FF") == -255
+    assert fmt.parse("FG") is None
+    assert fmt.parse("-") is None
+    assert fmt.parse("dup") is None
+    assert fmt.parse("0x1F") == 31
+    assert fmt.parse("+f_f") == 255
+    assert fmt.format(-255) == "-FF"
+    assert fmt.format(0) == "0"
+    assert NumberFormat(36).format(27622) == "LBA"
+    assert NumberFormat(3).format(5) == "12"
+finally:
+    del fmt
+
+# the literal memo starts again when full, so new literals still get in
+fmt = NumberFormat(10)
+try:
+    for n in range(LITERAL_CACHE_SIZE + 1):
+        assert fmt.parse(str(n)) == n
+    assert "4096" in fmt.literals
+    assert len(fmt.literals) <= LITERAL_CACHE_SIZE
+finally:
+    del fmt
+
+# numbers int() accepts outside the plain digits still parse
+f = Forth(True)
+try:
+    f.do("1_000 +2")
+    assert f.S() == [1000, 2]
+finally:
+    del f
+
+# changing base after a number was parsed doesn't reuse the old value
+f = Forth(True)
+try:
+    f.do("10 hex 10 decimal 10")
+    assert f.S() == [10, 16, 10]
+finally:
+    del f
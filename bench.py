@@ -0,0 +1,382 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from FPython import Body, Forth, NumberFormat, Object, SessionPool
+
+
+def best(run, repeat):
+    # best of several timings, in seconds
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def session(words=0):
+    # a session with a given number of extra, distinct, compound words
+    f = Forth(True)
+    f.do(" ".join(
+        ": w" + str(n) + " " + str(n) + " drop ;"
+        for n in range(words)
+    ))
+    return f
+
+
+def bench_tokenize(size, repeat):
+    f = Forth(True)
+    text = "dup " * size
+
+    def run():
+        f.input_buffer = text
+        while len(f.input_buffer) > 0:
+            f.pop_token()
+    return {"seconds": best(run, repeat), "ops": size}
+
+
+def bench_skip(size, repeat):
+    f = Forth(True)
+    text = "comment ) " * size
+
+    def run():
+        f.input_buffer = text
+        while len(f.input_buffer) > 0:
+            f.skip(")")
+    return {"seconds": best(run, repeat), "ops": size}
+
+
+def bench_execute(words, depth, repeat):
+    f = session(words)
+    f.do("1 " * (depth + 1))
+    dup = f.lookup("dup")
+    drop = f.lookup("drop")
+
+    def run():
+        for _ in range(1000):
+            f.execute_valid_token(dup)
+            f.execute_valid_token(drop)
+    return {"seconds": best(run, repeat), "ops": 2000}
+
+
+def bench_dispatch(words, nesting, repeat):
+    # a chain of compound words, each calling the one before it
+    f = session(words)
+    f.do(": n0 1 drop ;")
+    for n in range(1, nesting):
+        f.do(": n" + str(n) + " n" + str(n - 1) + " " + str(n) + " drop ;")
+    top = f.lookup("n" + str(nesting - 1))
+
+    def run():
+        for _ in range(100):
+            f.execute_valid_token(top)
+    return {"seconds": best(run, repeat), "ops": 100 * nesting}
+
+
+def bench_compile(words, repeat):
+    text = " ".join(
+        ": c" + str(n) + " " + str(n) + " dup + ;"
+        for n in range(words)
+    )
+    # half of these are duplicates, to go through end_definition's dedup
+    text += " " + " ".join(
+        ": d" + str(n) + " " + str(n) + " dup + ;"
+        for n in range(0, words, 2)
+    )
+
+    def run():
+        f = Forth(True)
+        f.do(text)
+    return {"seconds": best(run, repeat), "ops": words + words // 2}
+
+
+def bench_include(lines, repeat):
+    with tempfile.NamedTemporaryFile("w", suffix=".fs", delete=False) as file:
+        for n in range(lines):
+            file.write(": i" + str(n) + " " + str(n) + " 1 + ; i" + str(n))
+            file.write(" drop \\ line " + str(n) + "\n")
+        path = file.name
+    try:
+        def run():
+            f = Forth(True)
+            f.do("include " + path)
+        return {"seconds": best(run, repeat), "ops": lines}
+    finally:
+        os.remove(path)
+
+
+def bench_orphans(words, repeat):
+    f = session(words)
+    # redefine half, to leave some orphans to find
+    f.do(" ".join(": w" + str(n) + " ;" for n in range(0, words, 2)))
+    return {"seconds": best(f.orphans, repeat), "ops": len(f.dictionary)}
+
+
+def bench_memory(cells, repeat):
+    f = Forth(True)
+    text = " ".join(
+        str(n) + " " + str(n) + " ! " + str(n) + " @ drop"
+        for n in range(1, cells)
+    )
+    return {"seconds": best(lambda: f.do(text), repeat), "ops": cells}
+
+
+def bench_construct(count, repeat):
+    def run():
+        for _ in range(count):
+            Forth(True)
+    return {"seconds": best(run, repeat), "ops": count}
+
+
+def bench_script(tokens, prepared, repeat):
+    # the same script run repeatedly, with do() or prepare() and run()
+    f = Forth(True)
+    script = "1 2 + dup * drop " * (tokens // 6)
+
+    def run():
+        for _ in range(100):
+            if prepared:
+                f.run(f.prepare(script))
+            else:
+                f.do(script)
+    return {"seconds": best(run, repeat), "ops": 100 * tokens}
+
+
+def bench_numbers(base, valid, repeat):
+    # parsing distinct tokens, numbers or not, with a fresh literal memo
+    # each time; words that aren't numbers get here when undefined
+    size = 10000
+    if valid:
+        tokens = [NumberFormat(base).format(n) for n in range(size)]
+    else:
+        tokens = ["w" + str(n) for n in range(size)]
+
+    def run():
+        parse = NumberFormat(base).parse
+        for token in tokens:
+            parse(token)
+    return {"seconds": best(run, repeat), "ops": size}
+
+
+def bench_literals(base, distinct, printed, repeat):
+    # a number-heavy script through do(), optionally printing each number
+    size = 4000
+    written = []
+    f = Forth(not printed, out=written.append)
+    f.do(str(base) + " base !")
+    fmt = NumberFormat(base)
+    # all of the same length, so none of them spell a word, like BD
+    first = base ** 3
+    if distinct:
+        numbers = range(first, first + size)
+    else:
+        numbers = [first + n % 100 for n in range(size)]
+    word = " . " if printed else " "
+    script = word.join(fmt.format(n) for n in numbers) + word
+
+    def run():
+        if distinct:
+            # as if each number was seen for the first time
+            f.current_format().literals.clear()
+        f.do(script)
+        del f.data[:]
+        written.clear()
+    return {"seconds": best(run, repeat), "ops": size}
+
+
+def bench_fork(words, cells, define, repeat):
+    # forking, and optionally defining a word in the fork, which is when
+    # it stops sharing the parent's dictionary
+    f = session(words)
+    f.do(str(cells) + " " + str(cells) + " !")
+    forks = 100 if define else 1000
+
+    def run():
+        for _ in range(forks):
+            child = f.fork()
+            if define:
+                child.do(": x 1 ;")
+    return {"seconds": best(run, repeat), "ops": forks}
+
+
+def bench_pool(workers, threads, repeat):
+    # a stand-in client sending requests to a session pool, and waiting
+    # for all of them; ops is the number of requests
+    requests = 200
+    setup = ": sum 0 swap 0 do i + loop ;"
+    with SessionPool(setup, workers, steps=10**6, threads=threads) as pool:
+        pool.run("1 sum")  # make sure the workers have started
+
+        def run():
+            futures = [
+                pool.submit(str(n) + " 100 + sum .")
+                for n in range(requests)
+            ]
+            for future in futures:
+                assert future.result().error is None
+        seconds = best(run, repeat)
+    return {
+        "seconds": seconds,
+        "ops": requests,
+        "requests_per_second": round(requests / seconds),
+    }
+
+
+def tuple_body(n):
+    # the old encoding, kept here for comparison
+    body = [(Object.Literal, n), (Object.Word, n % 50), (Object.Word, 7)]
+    body.append((Object.Return, 0))
+    return body
+
+
+def array_body(n):
+    body = Body()
+    body.append(Object.Literal, n)
+    body.append(Object.Word, n % 50)
+    body.append(Object.Word, 7)
+    body.append(Object.Return, 0)
+    return body
+
+
+def measure(make, words):
+    tracemalloc.start()
+    dictionary = [(0, 1, None, make(n)) for n in range(words)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del dictionary
+    return size
+
+
+def bench_bodies(words, repeat):
+    return {
+        "tuple_bytes": measure(tuple_body, words),
+        "array_bytes": measure(array_body, words),
+    }
+
+
+# name: (function, parameter names, parameter sets)
+BENCHMARKS = {
+    "tokenize": (bench_tokenize, ["size"], [[1000], [10000], [100000]]),
+    "skip": (bench_skip, ["size"], [[1000], [10000], [100000]]),
+    "execute": (
+        bench_execute,
+        ["words", "depth"],
+        [[0, 0], [0, 1000], [0, 100000], [1000, 0], [10000, 0]],
+    ),
+    "dispatch": (
+        bench_dispatch,
+        ["words", "nesting"],
+        [[0, 10], [0, 100], [1000, 100], [10000, 100]],
+    ),
+    "compile": (bench_compile, ["words"], [[100], [1000], [3000]]),
+    "include": (bench_include, ["lines"], [[100], [1000], [5000]]),
+    "orphans": (bench_orphans, ["words"], [[100], [1000], [3000]]),
+    "memory": (bench_memory, ["cells"], [[100], [1000], [10000]]),
+    "construct": (bench_construct, ["count"], [[10], [100]]),
+    "script": (
+        bench_script,
+        ["tokens", "prepared"],
+        [[60, 0], [60, 1], [6000, 0], [6000, 1]],
+    ),
+    "numbers": (
+        bench_numbers,
+        ["base", "valid"],
+        [[10, 1], [10, 0], [16, 1], [16, 0]],
+    ),
+    "literals": (
+        bench_literals,
+        ["base", "distinct", "printed"],
+        [
+            [10, 1, 0], [10, 0, 0], [10, 1, 1], [10, 0, 1],
+            [16, 1, 0], [16, 1, 1],
+        ],
+    ),
+    "fork": (
+        bench_fork,
+        ["words", "cells", "define"],
+        [
+            [0, 0, 0], [10000, 0, 0], [0, 100000, 0], [10000, 100000, 0],
+            [10000, 0, 1], [100000, 0, 1],
+        ],
+    ),
+    "pool": (
+        bench_pool,
+        ["workers", "threads"],
+        [[1, 1], [4, 1], [1, 0], [4, 0]],
+    ),
+    "bodies": (bench_bodies, ["words"], [[100000]]),
+}
+
+
+def run(names, repeat, quick):
+    results = []
+    for name in names:
+        fun, params, sets = BENCHMARKS[name]
+        if quick:
+            sets = sets[:1]
+        for values in sets:
+            result = {"name": name, **dict(zip(params, values))}
+            result.update(fun(*values, repeat))
+            if "ops" in result:
+                result["ns_per_op"] = round(
+                    result["seconds"] * 1e9 / max(result["ops"], 1)
+                )
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+    return results
+
+
+def key(result):
+    return tuple(
+        (k, v)
+        for k, v in result.items()
+        if k not in ("seconds", "ops", "ns_per_op", "requests_per_second")
+        and not k.endswith("_bytes")
+    )
+
+
+def compare(old_path, new_path):
+    with open(old_path) as file:
+        old = {key(r): r for r in json.load(file)}
+    with open(new_path) as file:
+        new = json.load(file)
+    for result in new:
+        before = old.get(key(result))
+        if before is None or "seconds" not in result:
+            continue
+        ratio = before["seconds"] / result["seconds"]
+        label = " ".join(str(v) for _, v in key(result))
+        print(label.ljust(30), format(ratio, ".2f") + "x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time FPython's hot paths, writing results as JSON."
+    )
+    parser.add_argument("names", nargs="*", help="benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quick", action="store_true",
+                        help="only run the smallest size of each")
+    parser.add_argument("--out", help="file to write JSON results to")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="print speedups of NEW over OLD and exit")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmarks: " + ", ".join(unknown))
+    results = run(names, args.repeat, args.quick)
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        print()